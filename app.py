@@ -1,23 +1,29 @@
 import os
+import asyncio
+import functools
+import multiprocessing
 import json
 import base64
 import time
 import re
-from io import BytesIO
-from typing import Optional, Dict, Any, List
-
-import requests
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import PlainTextResponse
-from pydantic import BaseModel, EmailStr
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+from typing import Optional, Dict, Any, List, MutableMapping, Tuple
+
+import httpx
+import orjson
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from pydantic import BaseModel, field_validator
 from sqlalchemy import text
-from urllib.parse import parse_qs
 from twilio.rest import Client as TwilioRestClient
-from twilio.twiml.messaging_response import MessagingResponse
 from db import SessionLocal
+from pdf import FMT_BRL, render_pdf_reportlab
 
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
 
 
 # =========================
@@ -29,22 +35,85 @@ COMPANY_NAME = os.getenv("COMPANY_NAME", "Marca Nova Digital")
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")  # opcional no começo (dry-run)
 FROM_EMAIL = os.getenv("FROM_EMAIL")              # precisa estar verificado no SendGrid p/ enviar
 
+# Cliente HTTP async compartilhado (pool + keep-alive + HTTP/2): nao bloqueia
+# o event loop e evita TCP+TLS novo a cada envio
+SENDGRID_URL = "https://api.sendgrid.com/v3/mail/send"
+MAX_ATTACH = 28 * 1024 * 1024  # anexo ja em base64; limite do SendGrid e 30MB por e-mail
+SENDGRID_CLIENT = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    timeout=30,
+    headers={
+        "Authorization": f"Bearer {SENDGRID_API_KEY}",
+        "Content-Type": "application/json",
+    } if SENDGRID_API_KEY else None,
+)
+
 # Vendedores: JSON em string
 # Ex: {"+5567999999999":{"name":"Vendedor 1","email":"vendedor@empresa.com"}}
 SELLERS_JSON = os.getenv("SELLERS_JSON", "{}")
 
+
+def _load_sellers(raw: str) -> Dict[str, Dict[str, Any]]:
+    # valida uma vez no startup; config invalida vira "sem vendedores" (sem CC)
+    try:
+        sellers = json.loads(raw or "{}")
+    except ValueError as e:
+        print("SELLERS_JSON invalido, ignorando:", e)
+        return {}
+    if not isinstance(sellers, dict):
+        print("SELLERS_JSON deve ser um objeto {telefone: {...}}, ignorando")
+        return {}
+    return {phone: seller for phone, seller in sellers.items() if isinstance(seller, dict)}
+
+
+_SELLERS = _load_sellers(SELLERS_JSON)
+# telefone normalizado (sem "whatsapp:") -> email: um unico get por envio
+_SELLER_EMAILS: Dict[str, str] = {
+    phone.replace("whatsapp:", ""): seller["email"]
+    for phone, seller in _SELLERS.items() if seller.get("email")
+}
+
+# PDF: pool de processos (ReportLab e CPU-bound e segura o GIL).
+# forkserver: os workers nascem sob demanda, com o uvicorn ja cheio de threads;
+# fork ali pode herdar lock travado e deadlockar o filho. O worker so importa
+# pdf.py (render_pdf_reportlab vive la), nao este modulo
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "4"))
+_PDF_POOL = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+
 # Regras comerciais
 INSTALL_RATE_DEFAULT = 0.40
 DISCOUNT_CASH = 0.10
 CARD_INSTALLMENTS = 3
 
+# Sessoes: no Redis quando REDIS_URL estiver setado (estado compartilhado entre
+# workers/replicas e sobrevive a restart); senao, em memoria (MVP / dev).
+# TTLCache expira sozinho, sem varrer o dict
+REDIS_URL = os.getenv("REDIS_URL")
+_redis = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+SESSION_TTL_SECONDS = 2 * 60 * 60  # 2h
+SESSION_MAXSIZE = 10_000
+
 # Sessao de wizard em memoria (MVP)
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+SESSIONS: MutableMapping[str, Dict[str, Any]] = TTLCache(maxsize=SESSION_MAXSIZE, ttl=SESSION_TTL_SECONDS)
 
 
 # Sessao do webhook Twilio WhatsApp (MVP)
-SESSION_TTL_SECONDS = 2 * 60 * 60  # 2h
-_sessions: Dict[str, Dict[str, Any]] = {}  # key: seller_phone (whatsapp:+55...)
+_sessions: MutableMapping[str, Dict[str, Any]] = TTLCache(maxsize=SESSION_MAXSIZE, ttl=SESSION_TTL_SECONDS)  # key: seller_phone (whatsapp:+55...)
+
+# Jobs de geracao/envio de proposta em background: Redis (job:<id>) quando
+# configurado, p/ o status responder de qualquer worker; senao, em memoria
+JOB_TTL_SECONDS = 24 * 60 * 60  # 24h
+JOB_MAXSIZE = 100_000  # entradas pequenas; nao deve expulsar job antes do TTL
+_jobs: MutableMapping[str, Dict[str, Any]] = TTLCache(maxsize=JOB_MAXSIZE, ttl=JOB_TTL_SECONDS)  # key: job_id
+
+# Trava de idempotencia do "confirmar" (retries do Twilio / mensagens duplicadas)
+SUBMIT_LOCK_SECONDS = 10
+_submit_locks: MutableMapping[str, bool] = TTLCache(maxsize=SESSION_MAXSIZE, ttl=SUBMIT_LOCK_SECONDS)
+
+
+# TTLCache so expira ao ser tocado; a varredura periodica libera o que ficou parado
+SWEEP_INTERVAL_SECONDS = 10 * 60  # 10min
 
 
 # Catalogo MVP do novo fluxo WhatsApp
@@ -168,16 +237,52 @@ def _now() -> float:
     return time.time()
 
 
-def _cleanup_sessions():
-    t = _now()
-    expired = [k for k, v in _sessions.items() if (t - v.get("updated_at", 0)) > SESSION_TTL_SECONDS]
-    for k in expired:
-        _sessions.pop(k, None)
+async def _sweep_expired():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+        for cache in (SESSIONS, _sessions, _jobs, _submit_locks):
+            cache.expire()
+
+
+async def _load_state(local: MutableMapping[str, Dict[str, Any]], prefix: str, key: str) -> Optional[Dict[str, Any]]:
+    if _redis is None:
+        return local.get(key)
+    raw = await _redis.get(f"{prefix}:{key}")
+    return orjson.loads(raw) if raw else None
+
+
+async def _store_state(local: MutableMapping[str, Dict[str, Any]], prefix: str, key: str, s: Dict[str, Any],
+                       ttl: int = SESSION_TTL_SECONDS):
+    # grava uma vez por requisicao (fim do handler), renovando o TTL
+    if _redis is None:
+        local[key] = s
+        return
+    await _redis.set(f"{prefix}:{key}", orjson.dumps(s), ex=ttl)
+
 
+async def _store_job(job_id: str, job: Dict[str, Any]):
+    await _store_state(_jobs, "job", job_id, job, ttl=JOB_TTL_SECONDS)
 
-def _get_session(seller: str) -> Dict[str, Any]:
-    _cleanup_sessions()
-    s = _sessions.get(seller)
+
+async def _acquire_submit_lock(key: str) -> bool:
+    """
+    SETNX com TTL curto: so a primeira de duas requisicoes concorrentes de
+    "confirmar" gera a proposta.
+    """
+    if _redis is None:
+        if key in _submit_locks:
+            return False
+        _submit_locks[key] = True
+        return True
+    return bool(await _redis.set(f"lock:submit:{key}", "1", nx=True, ex=SUBMIT_LOCK_SECONDS))
+
+
+class _AlreadySubmitting(Exception):
+    """Confirmacao duplicada: a sessao nao deve ser regravada."""
+
+
+async def _get_session(seller: str) -> Dict[str, Any]:
+    s = await _load_state(_sessions, "sess", seller)
     if not s:
         s = {
             "state": "MENU",
@@ -186,13 +291,17 @@ def _get_session(seller: str) -> Dict[str, Any]:
                 "client_email": None,
                 "selected_keys": [],
                 "quantities": {},  # key -> int
+                "pending_keys": [],  # fila de itens sem quantidade
             },
             "updated_at": _now(),
         }
-        _sessions[seller] = s
     return s
 
 
+async def _store_session(seller: str, s: Dict[str, Any]):
+    await _store_state(_sessions, "sess", seller, s)
+
+
 def _set_state(s: Dict[str, Any], state: str):
     s["state"] = state
     s["updated_at"] = _now()
@@ -204,6 +313,7 @@ def _reset_draft(s: Dict[str, Any]):
         "client_email": None,
         "selected_keys": [],
         "quantities": {},
+        "pending_keys": [],
     }
     s["updated_at"] = _now()
 
@@ -212,9 +322,12 @@ def _normalize_text(text: str) -> str:
     return (text or "").strip()
 
 
+_EMAIL_RE = re.compile(r"^[^\s@]+@[^\s@]+\.[^\s@]{2,}$")
+_DIGITS_RE = re.compile(r"\d+")
+
+
 def _is_email(email: str) -> bool:
-    email = email.strip()
-    return bool(re.match(r"^[^\s@]+@[^\s@]+\.[^\s@]{2,}$", email))
+    return bool(_EMAIL_RE.match(email.strip()))
 
 
 def quantifier_for_item(item_key: str) -> str:
@@ -222,17 +335,23 @@ def quantifier_for_item(item_key: str) -> str:
     return "Quantas" if gender == "f" else "Quantos"
 
 
-def _render_catalog_menu() -> str:
-    lines = [
+# CATALOG e constante: o menu e montado uma vez no import
+_CATALOG_MENU_TEXT = "\n".join(
+    [
         "Selecione os itens digitando os numeros separados por virgula.",
         "Exemplo: 1,3,8",
         "",
     ]
-    for i, (_, item) in enumerate(CATALOG.items(), start=1):
-        lines.append(f"{i}) {item['label']}")
-    lines.append("")
-    lines.append("Comandos: cancelar | menu")
-    return "\n".join(lines)
+    + [f"{i}) {item['label']}" for i, item in enumerate(CATALOG.values(), start=1)]
+    + ["", "Comandos: cancelar | menu"]
+)
+
+
+def _render_catalog_menu() -> str:
+    return _CATALOG_MENU_TEXT
+
+
+_MENU_TEXT = "Menu:\n1) Iniciar proposta\n2) Continuar proposta\n3) Cancelar"
 
 
 def _summary(draft: Dict[str, Any]) -> str:
@@ -254,42 +373,23 @@ def _summary(draft: Dict[str, Any]) -> str:
     return "\n".join(lines)
 
 
+def _queue_qty_keys(draft: Dict[str, Any]):
+    # monta a fila uma vez por selecao; depois cada resposta so consome a cabeca
+    qty = draft.get("quantities", {})
+    draft["pending_keys"] = [k for k in draft.get("selected_keys", []) if k not in qty]
+
+
 def _next_qty_key(draft: Dict[str, Any]) -> Optional[str]:
-    for k in draft.get("selected_keys", []):
-        if k not in draft.get("quantities", {}):
-            return k
-    return None
+    pending = draft.get("pending_keys")
+    return pending[0] if pending else None
 
 
 def money(x: float) -> float:
     return round(float(x), 2)
 
-def split_text(text: str, max_len: int):
-    words = (text or "").split()
-    lines, cur = [], []
-    cur_len = 0
-    for w in words:
-        add_len = len(w) + (1 if cur else 0)
-        if cur_len + add_len > max_len:
-            lines.append(" ".join(cur))
-            cur = [w]
-            cur_len = len(w)
-        else:
-            cur.append(w)
-            cur_len += add_len
-    if cur:
-        lines.append(" ".join(cur))
-    return lines
 
 def resolve_seller_email(seller_phone: str) -> Optional[str]:
-    try:
-        sellers = json.loads(SELLERS_JSON or "{}")
-        seller = sellers.get(seller_phone)
-        if not seller:
-            return None
-        return seller.get("email")
-    except Exception:
-        return None
+    return _SELLER_EMAILS.get(seller_phone.replace("whatsapp:", ""))
 
 
 def load_session(wa_from: str):
@@ -307,7 +407,7 @@ def save_session(wa_from: str, state: str, payload: dict):
             values (:w,:s,:p, now())
             on conflict (wa_from) do update
             set state=excluded.state, payload=excluded.payload, updated_at=now()
-        """), {"w": wa_from, "s": state, "p": json.dumps(payload)})
+        """), {"w": wa_from, "s": state, "p": orjson.dumps(payload).decode()})
         db.commit()
 
 
@@ -326,25 +426,61 @@ WIZARD_ITEMS_ORDER = [
 
 def twiml(message: str) -> str:
     # resposta simples TwiML (WhatsApp)
-    safe = (message or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-    return f'<?xml version="1.0" encoding="UTF-8"?><Response><Message>{safe}</Message></Response>'
-
-
-def get_session(user_id: str) -> Dict[str, Any]:
-    if user_id not in SESSIONS:
-        SESSIONS[user_id] = {
-            "step": "idle",
-            "seller_phone": user_id.replace("whatsapp:", "").replace(" ", ""),
-            "client": {"name": "", "email": "", "phone": "", "address": ""},
-            "items": {k: 0 for k, _ in WIZARD_ITEMS_ORDER},
-            "notes": "",
-        }
-    return SESSIONS[user_id]
+    return f'<?xml version="1.0" encoding="UTF-8"?><Response><Message>{escape(message or "", quote=False)}</Message></Response>'
+
+
+# Respostas fixas mais comuns dos webhooks, ja serializadas (bytes) no import
+_TWIML_EMPTY = b'<?xml version="1.0" encoding="UTF-8"?><Response/>'
+_TWIML_CACHE: Dict[str, bytes] = {
+    m: twiml(m).encode()
+    for m in (
+        _MENU_TEXT,
+        "Ok. Proposta cancelada.\n\nDigite:\n1) Iniciar proposta\n2) Continuar proposta",
+        "Vamos la. Qual o nome do cliente (ou empresa)?",
+        "Agora informe o email do cliente:",
+        "Selecione um item na lista. Eu vou montando o carrinho.",
+        "Use a lista para selecionar itens.",
+        "Responda com: confirmar | editar | cancelar",
+        "Proposta em processamento. O cliente recebe por email em instantes.\n\nDigite:\n1) Iniciar proposta\n2) Continuar proposta",
+        "Proposta ja esta em processamento. Aguarde.",
+        "Responda apenas 'sim' ou 'nao'.",
+        "Nao entendi. Digite 'ajuda'.",
+    )
+}
+
+
+def _twiml_reply(message: Optional[str]) -> PlainTextResponse:
+    # message=None -> TwiML vazio (a resposta sai por outro canal, ex.: lista)
+    if message is None:
+        content = _TWIML_EMPTY
+    else:
+        content = _TWIML_CACHE.get(message) or twiml(message).encode()
+    return PlainTextResponse(content, media_type="application/xml")
+
+
+def _new_wizard_session(user_id: str) -> Dict[str, Any]:
+    return {
+        "step": "idle",
+        "seller_phone": user_id.replace("whatsapp:", "").replace(" ", ""),
+        "client": {"name": "", "email": "", "phone": "", "address": ""},
+        "items": {k: 0 for k, _ in WIZARD_ITEMS_ORDER},
+        "notes": "",
+    }
+
+
+async def get_session(user_id: str) -> Dict[str, Any]:
+    s = await _load_state(SESSIONS, "wiz", user_id)
+    return s if s is not None else _new_wizard_session(user_id)
+
+
+async def store_session(user_id: str, s: Dict[str, Any]):
+    await _store_state(SESSIONS, "wiz", user_id, s)
 
 
-def reset_session(user_id: str):
-    if user_id in SESSIONS:
-        del SESSIONS[user_id]
+def reset_session(user_id: str, s: Dict[str, Any]):
+    # volta ao estado inicial; a sessao e gravada no fim do handler
+    s.clear()
+    s.update(_new_wizard_session(user_id))
 
 
 def parse_int_0_99(text: str) -> Optional[int]:
@@ -368,37 +504,64 @@ def next_item_prompt(idx: int) -> Optional[str]:
         return WIZARD_ITEMS_ORDER[idx][1]
     return None
 
+# Tabela de precos congelada no import: sku -> (label, unit, label do PDF, unit formatado)
+_SKU_TABLE: Dict[str, Tuple[str, float, str, str]] = {
+    sku: (LABELS.get(sku, sku), float(unit), LABELS.get(sku, sku)[:40], FMT_BRL(unit))
+    for sku, unit in UNIT_PRICES.items()
+}
+
+
 def compute_quote(items: Dict[str, int]) -> Dict[str, Any]:
-    breakdown = []
-    material_total = 0.0
-    labor_total = 0.0
+    """
+    Orcamento a partir de {sku: qty}. O calculo vem de um cache; cada chamada
+    recebe seus proprios dicts/listas, entao o caller pode alterar o
+    resultado sem afetar o cache.
+    """
+    key = tuple((sku, q) for sku, q in ((sku, int(qty or 0)) for sku, qty in items.items()) if q > 0)
+    q = _compute_quote_cached(key)
+    return {
+        "breakdown": [dict(b) for b in q["breakdown"]],
+        "breakdown_rows": q["breakdown_rows"],  # tupla de tuplas (imutavel)
+        "totals": {**q["totals"], "rules": dict(q["totals"]["rules"])},
+    }
 
-    for sku, qty in items.items():
-        qty_int = int(qty or 0)
-        if qty_int <= 0:
-            continue
 
-        unit = float(UNIT_PRICES.get(sku, 0.0))
+@functools.lru_cache(maxsize=1024)
+def _compute_quote_cached(items: Tuple[Tuple[str, int], ...]) -> Dict[str, Any]:
+    breakdown = []
+    breakdown_rows = []  # linhas ja formatadas p/ o PDF: (label, qtd, unit, total)
+    material_total = 0.0
+    # lookups fora do loop (LOAD_GLOBAL/LOAD_ATTR uma vez so)
+    row_of = _SKU_TABLE.get
+    fmt = FMT_BRL
+    add_item = breakdown.append
+    add_row = breakdown_rows.append
+
+    for sku, qty_int in items:
+        row = row_of(sku)
+        if row is None:  # sku fora da tabela: preco zero
+            row = (sku, 0.0, sku[:40], fmt(0.0))
+        label, unit, pdf_label, unit_fmt = row
         material = qty_int * unit
-        labor = qty_int * unit * INSTALL_RATE_DEFAULT  # 40% do item
-
         material_total += material
-        labor_total += labor
 
-        breakdown.append({
+        add_item({
             "sku": sku,
-            "label": LABELS.get(sku, sku),
+            "label": label,
             "qty": qty_int,
             "unit_price": money(unit),
             "material": money(material),
         })
+        add_row((pdf_label, str(qty_int), unit_fmt, fmt(material)))
 
+    labor_total = material_total * INSTALL_RATE_DEFAULT  # 40% dos materiais
     grand_total = material_total + labor_total
     cash_total = grand_total * (1.0 - DISCOUNT_CASH)
     installment_value = grand_total / CARD_INSTALLMENTS
 
     return {
-        "breakdown": breakdown,
+        "breakdown": tuple(breakdown),
+        "breakdown_rows": tuple(breakdown_rows),
         "totals": {
             "material_total": money(material_total),
             "labor_total": money(labor_total),
@@ -413,107 +576,35 @@ def compute_quote(items: Dict[str, int]) -> Dict[str, Any]:
         }
     }
 
-def render_pdf_reportlab(context: dict) -> bytes:
+
+# referencias fortes p/ tasks em background (o loop so guarda weakref)
+_background_tasks: set = set()
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def render_pdf_async(context: dict) -> bytes:
     """
-    Gera PDF (A4) com:
-      - Materiais detalhados
-      - Mão de obra (total)
-      - Condições de pagamento
+    Roda render_pdf_reportlab no _PDF_POOL sem bloquear o event loop.
+    context precisa ser picklable (dict simples).
     """
-    buf = BytesIO()
-    c = canvas.Canvas(buf, pagesize=A4)
-    width, height = A4
-
-    x = 40
-    y = height - 50
-
-    def line(txt, dy=16, bold=False, size=11):
-        nonlocal y
-        c.setFont("Helvetica-Bold" if bold else "Helvetica", size)
-        c.drawString(x, y, txt)
-        y -= dy
-
-    # Header
-    c.setFont("Helvetica-Bold", 15)
-    c.drawString(x, y, "Proposta de Automação")
-    y -= 18
-    c.setFont("Helvetica", 11)
-    c.drawString(x, y, context.get("company_name", COMPANY_NAME))
-    y -= 24
-
-    # Cliente
-    client = context["client"]
-    line("Cliente", bold=True)
-    line(f"Nome: {client.get('name','')}")
-    line(f"E-mail: {client.get('email','')}")
-    line(f"Telefone: {client.get('phone','')}")
-    addr = client.get("address")
-    if addr:
-        line(f"Endereço: {addr}")
-    y -= 10
-
-    # Observações
-    notes = (context.get("notes") or "").strip()
-    if notes:
-        line("Observações da vistoria", bold=True)
-        for chunk in split_text(notes, 95):
-            line(chunk, size=10, dy=13)
-        y -= 10
-
-    # Materiais - tabela
-    line("Materiais", bold=True)
-
-    c.setFont("Helvetica-Bold", 10)
-    c.drawString(x, y, "Item")
-    c.drawString(x + 270, y, "Qtd")
-    c.drawString(x + 320, y, "Unit")
-    c.drawString(x + 400, y, "Total")
-    y -= 14
-
-    c.setFont("Helvetica", 10)
-    for row in context["breakdown"]:
-        if y < 140:
-            c.showPage()
-            y = height - 50
-
-        c.drawString(x, y, row["label"][:40])
-        c.drawRightString(x + 300, y, str(row["qty"]))
-        c.drawRightString(x + 380, y, f"R$ {row['unit_price']:.2f}")
-        c.drawRightString(x + 520, y, f"R$ {row['material']:.2f}")
-        y -= 14
-
-    y -= 12
-
-    totals = context["totals"]
-    line(f"Total materiais: R$ {totals['material_total']:.2f}", bold=True)
-    line(f"Mão de obra: R$ {totals['labor_total']:.2f}", bold=True)
-    line(f"Valor total: R$ {totals['grand_total']:.2f}", bold=True)
-    y -= 6
-
-    line("Condições de pagamento", bold=True)
-    line(f"À vista (10% desconto): R$ {totals['cash_total']:.2f}")
-    line(f"Cartão: {totals['card_installments']}x sem juros de R$ {totals['card_installment_value']:.2f}")
-    y -= 10
-
-    c.setFont("Helvetica", 9)
-    c.drawString(x, y, "Valores calculados automaticamente com base no escopo informado.")
-    y -= 12
-
-    c.showPage()
-    c.save()
-    return buf.getvalue()
-
-def send_email_sendgrid(to_email: str, cc_email: Optional[str], subject: str, html_body: str, pdf_bytes: bytes, filename: str):
+    return await asyncio.get_running_loop().run_in_executor(_PDF_POOL, render_pdf_reportlab, context)
+
+
+async def send_email_sendgrid(to_email: str, cc_email: Optional[str], subject: str, html_body: str, pdf_b64: str, filename: str):
     """
-    Envia e-mail via SendGrid com PDF anexado.
+    Envia e-mail via SendGrid com PDF anexado (pdf_b64: PDF ja em base64).
     Se SENDGRID_API_KEY ou FROM_EMAIL não estiverem setados, NÃO envia (dry-run) e retorna.
     """
     if not SENDGRID_API_KEY or not FROM_EMAIL:
         # Dry-run: backend funciona sem SendGrid configurado ainda.
         return {"sent": False, "reason": "SENDGRID_API_KEY/FROM_EMAIL not configured (dry-run)"}
 
-    attachment_b64 = base64.b64encode(pdf_bytes).decode("utf-8")
-
     payload = {
         "personalizations": [{
             "to": [{"email": to_email}],
@@ -523,22 +614,14 @@ def send_email_sendgrid(to_email: str, cc_email: Optional[str], subject: str, ht
         "subject": subject,
         "content": [{"type": "text/html", "value": html_body}],
         "attachments": [{
-            "content": attachment_b64,
+            "content": pdf_b64,
             "type": "application/pdf",
             "filename": filename,
             "disposition": "attachment"
         }]
     }
 
-    r = requests.post(
-        "https://api.sendgrid.com/v3/mail/send",
-        headers={
-            "Authorization": f"Bearer {SENDGRID_API_KEY}",
-            "Content-Type": "application/json",
-        },
-        json=payload,
-        timeout=30
-    )
+    r = await SENDGRID_CLIENT.post(SENDGRID_URL, content=orjson.dumps(payload))
 
     if r.status_code not in (200, 202):
         raise RuntimeError(f"SendGrid erro {r.status_code}: {r.text}")
@@ -551,10 +634,19 @@ def send_email_sendgrid(to_email: str, cc_email: Optional[str], subject: str, ht
 # =========================
 class Client(BaseModel):
     name: str
-    email: EmailStr
+    email: str
     phone: str
     address: Optional[str] = None
 
+    @field_validator("email")
+    @classmethod
+    def _check_email(cls, v: str) -> str:
+        # regex simples (mesma do WhatsApp); bounce fica a cargo do SendGrid
+        v = v.strip()
+        if not _EMAIL_RE.match(v):
+            raise ValueError("e-mail invalido")
+        return v
+
 class FlowSubmit(BaseModel):
     seller_phone: str
     client: Client
@@ -565,7 +657,7 @@ class FlowSubmit(BaseModel):
 # =========================
 # FASTAPI APP
 # =========================
-app = FastAPI(title="Sendzap - Propostas Automação")
+app = FastAPI(title="Sendzap - Propostas Automação", default_response_class=ORJSONResponse)
 
 
 @app.on_event("startup")
@@ -574,6 +666,20 @@ def startup():
     init_db()
 
 
+@app.on_event("startup")
+async def start_sweeper():
+    app.state.sweeper = asyncio.create_task(_sweep_expired())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.sweeper.cancel()
+    _PDF_POOL.shutdown(wait=False, cancel_futures=True)
+    await SENDGRID_CLIENT.aclose()
+    if _redis is not None:
+        await _redis.aclose()
+
+
 @app.get("/")
 def root():
     return {"ok": True, "service": "sendzap"}
@@ -582,70 +688,171 @@ def root():
 def health():
     return {"ok": True}
 
-@app.post("/flow/submit")
-def flow_submit(payload: FlowSubmit):
-    quote = compute_quote(payload.items)
-
-    context = {
+def _pdf_context(payload: FlowSubmit, quote: Dict[str, Any]) -> Dict[str, Any]:
+    return {
         "company_name": COMPANY_NAME,
         "client": payload.client.model_dump(),
         "notes": payload.notes or "",
-        "breakdown": quote["breakdown"],
+        "breakdown_rows": quote["breakdown_rows"],
         "totals": quote["totals"],
     }
 
-    pdf_bytes = render_pdf_reportlab(context)
 
-    seller_email = resolve_seller_email(payload.seller_phone)
+# Nome do anexo: espacos e separadores de caminho viram "_"
+_FN_TABLE = str.maketrans({" ": "_", "/": "_", "\\": "_"})
 
-    subject = f"Proposta - Automação - {payload.client.name}"
-    html_body = f"""
-    <p>Olá, <b>{payload.client.name}</b>!</p>
+
+def _safe_filename(name: str) -> str:
+    return f"Proposta_{name.translate(_FN_TABLE)}.pdf"
+
+
+# Corpo do e-mail: template fixo; so o nome (escapado) e os totais mudam
+_EMAIL_HTML = """
+    <p>Olá, <b>{name}</b>!</p>
     <p>Segue em anexo sua proposta de automação.</p>
     <p>
-      <b>Valor total:</b> R$ {quote['totals']['grand_total']:.2f}<br/>
-      <b>À vista (10% off):</b> R$ {quote['totals']['cash_total']:.2f}<br/>
-      <b>Cartão:</b> {quote['totals']['card_installments']}x de R$ {quote['totals']['card_installment_value']:.2f} (sem juros)
+      <b>Valor total:</b> R$ {grand_total:.2f}<br/>
+      <b>À vista (10% off):</b> R$ {cash_total:.2f}<br/>
+      <b>Cartão:</b> {card_installments}x de R$ {card_installment_value:.2f} (sem juros)
     </p>
-    <p>— {COMPANY_NAME}</p>
+    <p>— {company}</p>
+    """.format
+
+
+def _prepare_submission(payload: FlowSubmit):
+    """
+    Calcula o orcamento e monta os argumentos de _render_and_send.
+    Retorna (quote, send_args).
     """
+    quote = compute_quote(payload.items)
+    context = _pdf_context(payload, quote)
+
+    seller_email = resolve_seller_email(payload.seller_phone)
+    # evita CC duplicado
+    if seller_email and seller_email.strip().lower() == str(payload.client.email).strip().lower():
+        seller_email = None
+
+    subject = f"Proposta - Automação - {payload.client.name}"
+    html_body = _EMAIL_HTML(name=escape(payload.client.name), company=COMPANY_NAME, **quote["totals"])
 
+    send_args = {
+        "context": context,
+        "to_email": str(payload.client.email),
+        "cc_email": seller_email,
+        "subject": subject,
+        "html_body": html_body,
+        "filename": _safe_filename(payload.client.name),
+    }
+    return quote, send_args
+
+
+async def _render_and_send(context: dict, to_email: str, cc_email: Optional[str], subject: str, html_body: str, filename: str, job_id: Optional[str] = None):
+    """
+    Gera o PDF e envia por e-mail (fora do request, via BackgroundTasks).
+    Se job_id for informado, atualiza o status do job (_store_job).
+    """
+    job = {"status": "running", "updated_at": _now()} if job_id else None
+    if job is not None:
+        await _store_job(job_id, job)
     try:
-        send_result = send_email_sendgrid(
-            to_email=str(payload.client.email),
-            cc_email=seller_email,
+        pdf_bytes = await render_pdf_async(context)
+        # tamanho do base64 sem codificar: falha antes de gastar CPU/upload
+        if 4 * ((len(pdf_bytes) + 2) // 3) > MAX_ATTACH:
+            raise RuntimeError(f"PDF grande demais para anexar ({len(pdf_bytes)} bytes)")
+        # codifica uma vez; o mesmo texto serve p/ cliente + CC
+        pdf_b64 = base64.b64encode(pdf_bytes).decode("ascii")
+        del pdf_bytes  # so o base64 segue vivo ate o POST
+        result = await send_email_sendgrid(
+            to_email=to_email,
+            cc_email=cc_email,
             subject=subject,
             html_body=html_body,
-            pdf_bytes=pdf_bytes,
-            filename=f"Proposta_{payload.client.name.replace(' ', '_')}.pdf"
+            pdf_b64=pdf_b64,
+            filename=filename,
         )
     except Exception as e:
-        raise HTTPException(status_code=502, detail=str(e))
+        if job is not None:
+            job.update(status="error", error=str(e), updated_at=_now())
+            await _store_job(job_id, job)
+        raise
+    if job is not None:
+        job.update(status="done", sendgrid=result, updated_at=_now())
+        await _store_job(job_id, job)
+    return result
+
+
+async def _generate_and_send(send_args: Dict[str, Any], notify_to: Optional[str] = None):
+    """
+    Versao "fire and forget" de _render_and_send usada pelos webhooks do
+    Twilio: se falhar, avisa o vendedor pelo WhatsApp.
+    """
+    try:
+        await _render_and_send(**send_args)
+    except Exception as e:
+        print("PROPOSTA_FALHOU:", send_args["to_email"], e)
+        if notify_to:
+            try:
+                await run_in_threadpool(
+                    wa_send_text,
+                    notify_to,
+                    f"Falha ao enviar a proposta para {send_args['to_email']}: {e}\n\nInicie uma nova proposta para tentar novamente.",
+                )
+            except Exception as e2:
+                print("WA_NOTIFY_FALHOU:", e2)
+
+
+@app.post("/flow/submit", status_code=202)
+async def flow_submit(payload: FlowSubmit, background_tasks: BackgroundTasks):
+    quote, send_args = _prepare_submission(payload)
+
+    job_id = uuid.uuid4().hex
+    await _store_job(job_id, {"status": "queued", "updated_at": _now()})
+    background_tasks.add_task(_render_and_send, job_id=job_id, **send_args)
 
     return {
         "ok": True,
-        "sent_to": str(payload.client.email),
-        "cc": seller_email,
-        "sendgrid": send_result,
+        "job_id": job_id,
+        "sent_to": send_args["to_email"],
+        "cc": send_args["cc_email"],
         "totals": quote["totals"],
         "items_count": len(quote["breakdown"]),
     }
 
 
+@app.get("/flow/status/{job_id}")
+async def flow_status(job_id: str):
+    job = await _load_state(_jobs, "job", job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job nao encontrado")
+    return {"job_id": job_id, **job}
+
+
 @app.post("/twilio/whatsapp")
 async def twilio_whatsapp(request: Request):
     """
     Webhook inbound do WhatsApp via Twilio.
     Recebe form-url-encoded (Body, From, etc).
-    Responde TwiML (MessagingResponse).
+    Responde TwiML.
     """
     form = await request.form()
     print("TWILIO_FORM_KEYS:", list(dict(form).keys()))
     print("TWILIO_FORM:", dict(form))
     wa_from = form.get("From", "")  # ex: "whatsapp:+5567..."
-    body = _normalize_text(form.get("Body", ""))
 
-    s = _get_session(wa_from)
+    s = await _get_session(wa_from)
+    try:
+        return await _whatsapp_turn(wa_from, form, s)
+    except _AlreadySubmitting:
+        s = None  # duplicada: nao regrava a sessao lida antes do confirmar
+        return _twiml_reply("Proposta ja esta em processamento. Aguarde.")
+    finally:
+        # grava mesmo se o turno falhar no meio (ex.: erro no Twilio/DB)
+        if s is not None:
+            await _store_session(wa_from, s)
+
+
+async def _whatsapp_turn(wa_from: str, form, s: Dict[str, Any]) -> PlainTextResponse:
+    body = _normalize_text(form.get("Body", ""))
     draft = s["draft"]
     state = s["state"]
 
@@ -655,79 +862,63 @@ async def twilio_whatsapp(request: Request):
         _reset_draft(s)
         _set_state(s, "MENU")
         clear_session(wa_from)
-        resp = MessagingResponse()
-        resp.message("Ok. Proposta cancelada.\n\nDigite:\n1) Iniciar proposta\n2) Continuar proposta")
-        return PlainTextResponse(str(resp), media_type="application/xml")
+        return _twiml_reply("Ok. Proposta cancelada.\n\nDigite:\n1) Iniciar proposta\n2) Continuar proposta")
 
     if cmd in {"menu", "inicio", "start"}:
         _set_state(s, "MENU")
-        resp = MessagingResponse()
-        resp.message("Menu:\n1) Iniciar proposta\n2) Continuar proposta\n3) Cancelar")
-        return PlainTextResponse(str(resp), media_type="application/xml")
-
-    resp = MessagingResponse()
+        return _twiml_reply(_MENU_TEXT)
 
     if state == "MENU":
         if cmd in {"1", "iniciar", "nova", "novo"}:
             _reset_draft(s)
             _set_state(s, "CLIENT_NAME")
-            resp.message("Vamos la. Qual o nome do cliente (ou empresa)?")
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply("Vamos la. Qual o nome do cliente (ou empresa)?")
 
         if cmd in {"2", "continuar", "retomar"}:
             if not draft.get("client_name"):
                 _reset_draft(s)
                 _set_state(s, "CLIENT_NAME")
-                resp.message("Nao encontrei proposta em aberto. Vamos iniciar.\n\nQual o nome do cliente?")
-            else:
-                if not draft.get("client_email"):
-                    _set_state(s, "CLIENT_EMAIL")
-                    resp.message(f"Retomando. Cliente: {draft.get('client_name')}\n\nInforme o email do cliente:")
-                elif not draft.get("selected_keys") and not draft.get("items_selected"):
-                    _set_state(s, "pick_items_list")
-                    draft["items_selected"] = list(draft.get("selected_keys", []))
-                    save_session(wa_from, "pick_items_list", draft)
-                    wa_send_list_items(wa_from)
-                    resp.message("Selecione um item na lista. Eu vou montando o carrinho.")
-                else:
-                    if not draft.get("selected_keys") and draft.get("items_selected"):
-                        draft["selected_keys"] = list(draft["items_selected"])
-                    k = _next_qty_key(draft)
-                    if k:
-                        _set_state(s, "ask_qty")
-                        save_session(wa_from, "ask_qty", draft)
-                        q = f"{quantifier_for_item(k)} {CATALOG[k]['label']}?"
-                        resp.message(q)
-                    else:
-                        _set_state(s, "SUMMARY")
-                        resp.message(_summary(draft))
-            return PlainTextResponse(str(resp), media_type="application/xml")
-
-        resp.message("Menu:\n1) Iniciar proposta\n2) Continuar proposta\n3) Cancelar")
-        return PlainTextResponse(str(resp), media_type="application/xml")
+                return _twiml_reply("Nao encontrei proposta em aberto. Vamos iniciar.\n\nQual o nome do cliente?")
+            if not draft.get("client_email"):
+                _set_state(s, "CLIENT_EMAIL")
+                return _twiml_reply(f"Retomando. Cliente: {draft.get('client_name')}\n\nInforme o email do cliente:")
+            if not draft.get("selected_keys") and not draft.get("items_selected"):
+                _set_state(s, "pick_items_list")
+                draft["items_selected"] = list(draft.get("selected_keys", []))
+                save_session(wa_from, "pick_items_list", draft)
+                wa_send_list_items(wa_from)
+                return _twiml_reply("Selecione um item na lista. Eu vou montando o carrinho.")
+            if not draft.get("selected_keys") and draft.get("items_selected"):
+                draft["selected_keys"] = list(draft["items_selected"])
+            _queue_qty_keys(draft)
+            k = _next_qty_key(draft)
+            if k:
+                _set_state(s, "ask_qty")
+                save_session(wa_from, "ask_qty", draft)
+                return _twiml_reply(f"{quantifier_for_item(k)} {CATALOG[k]['label']}?")
+            _set_state(s, "SUMMARY")
+            return _twiml_reply(_summary(draft))
+
+        return _twiml_reply(_MENU_TEXT)
 
     if state == "CLIENT_NAME":
         if len(body) < 2:
-            resp.message("Nome muito curto. Informe o nome do cliente/empresa:")
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply("Nome muito curto. Informe o nome do cliente/empresa:")
         draft["client_name"] = body
         s["updated_at"] = _now()
         _set_state(s, "CLIENT_EMAIL")
-        resp.message("Agora informe o email do cliente:")
-        return PlainTextResponse(str(resp), media_type="application/xml")
+        return _twiml_reply("Agora informe o email do cliente:")
 
     if state == "CLIENT_EMAIL":
         if not _is_email(body):
-            resp.message("Email invalido. Digite novamente (ex.: nome@empresa.com):")
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply("Email invalido. Digite novamente (ex.: nome@empresa.com):")
         draft["client_email"] = body
         s["updated_at"] = _now()
         _set_state(s, "pick_items_list")
         draft["items_selected"] = list(draft.get("selected_keys", []))
         save_session(wa_from, "pick_items_list", draft)
         wa_send_list_items(wa_from)
-        resp.message("Selecione um item na lista. Eu vou montando o carrinho.")
-        return PlainTextResponse(str(resp), media_type="application/xml")
+        return _twiml_reply("Selecione um item na lista. Eu vou montando o carrinho.")
 
     if state == "pick_items_list":
         payload = draft
@@ -739,30 +930,29 @@ async def twilio_whatsapp(request: Request):
         # 1) Trata quick replies primeiro
         if "finalizar" in cmd:
             if not payload.get("items_selected"):
-                resp.message("Selecione pelo menos 1 item na lista.")
                 wa_send_list_items(wa_from)
-                return PlainTextResponse(str(resp), media_type="application/xml")
+                return _twiml_reply("Selecione pelo menos 1 item na lista.")
             payload["qty_index"] = 0
             payload["selected_keys"] = list(payload.get("items_selected", []))
+            _queue_qty_keys(payload)
             _set_state(s, "ask_qty")
             save_session(wa_from, "ask_qty", payload)
             k = payload["items_selected"][0]
             q = f"{quantifier_for_item(k)} *{LABEL_BY_KEY.get(k, k)}*?"
-            resp.message(q)
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply(q)
 
         if "adicionar" in cmd or cmd == "mais":
             wa_send_list_items(wa_from)
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply(None)
 
         if "limpar" in cmd:
             payload["items_selected"] = []
             payload["selected_keys"] = []
             payload["quantities"] = {}
+            payload["pending_keys"] = []
             save_session(wa_from, "pick_items_list", payload)
             wa_send_list_items(wa_from)
-            resp.message("Carrinho limpo. Selecione os itens novamente.")
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply("Carrinho limpo. Selecione os itens novamente.")
 
         # 2) Agora tenta selecao da lista
         selected = extract_selection(dict(form))
@@ -771,8 +961,7 @@ async def twilio_whatsapp(request: Request):
             if item_key.isdigit():
                 item_key = KEY_BY_INDEX.get(int(item_key), item_key)
             if item_key not in CATALOG:
-                resp.message("Item da lista nao reconhecido. Selecione novamente pela lista.")
-                return PlainTextResponse(str(resp), media_type="application/xml")
+                return _twiml_reply("Item da lista nao reconhecido. Selecione novamente pela lista.")
 
             payload.setdefault("items_selected", [])
             if item_key not in payload["items_selected"]:
@@ -783,34 +972,29 @@ async def twilio_whatsapp(request: Request):
             _set_state(s, "pick_items_list")
             save_session(wa_from, "pick_items_list", payload)
             current = ", ".join(LABEL_BY_KEY.get(x, x) for x in payload["items_selected"])
-            resp.message(
+            wa_send_pick_actions(wa_from)
+            return _twiml_reply(
                 f"✅ Adicionado: *{LABEL_BY_KEY.get(item_key, item_key)}*\n"
                 f"Carrinho: {current}"
             )
-            wa_send_pick_actions(wa_from)
-            return PlainTextResponse(str(resp), media_type="application/xml")
 
         # 3) fallback
-        resp.message("Use a lista para selecionar itens.")
         wa_send_list_items(wa_from)
-        return PlainTextResponse(str(resp), media_type="application/xml")
+        return _twiml_reply("Use a lista para selecionar itens.")
 
     if state in {"QTY", "ask_qty"}:
         k = _next_qty_key(draft)
         if not k:
             _set_state(s, "SUMMARY")
-            resp.message(_summary(draft))
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply(_summary(draft))
 
-        m = re.findall(r"\d+", body)
+        m = _DIGITS_RE.search(body)
         if not m:
             q = f"{quantifier_for_item(k)} {CATALOG[k]['label']}?"
-            resp.message(f"Digite apenas um numero.\n{q}")
-            return PlainTextResponse(str(resp), media_type="application/xml")
-        q = int(m[0])
+            return _twiml_reply(f"Digite apenas um numero.\n{q}")
+        q = int(m.group())
         if q < 0 or q > 100000:
-            resp.message("Quantidade invalida. Digite um numero valido.")
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply("Quantidade invalida. Digite um numero valido.")
 
         if q == 0:
             draft["selected_keys"] = [x for x in draft["selected_keys"] if x != k]
@@ -820,27 +1004,25 @@ async def twilio_whatsapp(request: Request):
             draft["quantities"][k] = q
             if "items_selected" in draft and k not in draft["items_selected"]:
                 draft["items_selected"].append(k)
+        draft["pending_keys"].pop(0)
 
         s["updated_at"] = _now()
         nextk = _next_qty_key(draft)
         if nextk:
-            q = f"{quantifier_for_item(nextk)} {CATALOG[nextk]['label']}?"
-            resp.message(q)
-        else:
-            _set_state(s, "SUMMARY")
-            resp.message(_summary(draft))
-        return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply(f"{quantifier_for_item(nextk)} {CATALOG[nextk]['label']}?")
+        _set_state(s, "SUMMARY")
+        return _twiml_reply(_summary(draft))
 
     if state == "SUMMARY":
         if cmd in {"editar", "edit", "2"}:
             draft["selected_keys"] = []
             draft["items_selected"] = []
             draft["quantities"] = {}
+            draft["pending_keys"] = []
             _set_state(s, "pick_items_list")
             save_session(wa_from, "pick_items_list", draft)
             wa_send_list_items(wa_from)
-            resp.message("Selecione um item na lista. Eu vou montando o carrinho.")
-            return PlainTextResponse(str(resp), media_type="application/xml")
+            return _twiml_reply("Selecione um item na lista. Eu vou montando o carrinho.")
 
         if cmd in {"confirmar", "confirm", "1"}:
             _set_state(s, "SUBMIT")
@@ -863,28 +1045,26 @@ async def twilio_whatsapp(request: Request):
                     items=items,
                     notes=None,
                 )
-                flow_submit(payload)
-
-                _reset_draft(s)
-                _set_state(s, "MENU")
-                clear_session(wa_from)
-                resp.message("Proposta enviada com sucesso para o email do cliente.\n\nDigite:\n1) Iniciar proposta\n2) Continuar proposta")
-                return PlainTextResponse(str(resp), media_type="application/xml")
-            except HTTPException as e:
-                _set_state(s, "SUMMARY")
-                resp.message(f"Falha ao gerar/enviar: {e.detail}\n\nResponda: confirmar | editar | cancelar")
-                return PlainTextResponse(str(resp), media_type="application/xml")
+                _, send_args = _prepare_submission(payload)
             except Exception as e:
                 _set_state(s, "SUMMARY")
-                resp.message(f"Falha ao gerar/enviar: {e}\n\nResponda: confirmar | editar | cancelar")
-                return PlainTextResponse(str(resp), media_type="application/xml")
+                return _twiml_reply(f"Falha ao gerar/enviar: {e}\n\nResponda: confirmar | editar | cancelar")
+
+            if not await _acquire_submit_lock(wa_from):
+                raise _AlreadySubmitting()
 
-        resp.message("Responda com: confirmar | editar | cancelar")
-        return PlainTextResponse(str(resp), media_type="application/xml")
+            # PDF + SendGrid fora do webhook: o Twilio recebe a resposta na hora
+            _spawn(_generate_and_send(send_args, notify_to=wa_from))
+
+            _reset_draft(s)
+            _set_state(s, "MENU")
+            clear_session(wa_from)
+            return _twiml_reply("Proposta em processamento. O cliente recebe por email em instantes.\n\nDigite:\n1) Iniciar proposta\n2) Continuar proposta")
+
+        return _twiml_reply("Responda com: confirmar | editar | cancelar")
 
     _set_state(s, "MENU")
-    resp.message("Menu:\n1) Iniciar proposta\n2) Continuar proposta\n3) Cancelar")
-    return PlainTextResponse(str(resp), media_type="application/xml")
+    return _twiml_reply(_MENU_TEXT)
 
 
 @app.post("/twilio/webhook", response_class=PlainTextResponse)
@@ -895,69 +1075,79 @@ async def twilio_webhook(request: Request):
       - From: whatsapp:+55...
       - Body: mensagem do usuario
     """
-    raw = await request.body()
-    form = parse_qs(raw.decode("utf-8"))
+    form = await request.form()
 
-    from_ = (form.get("From", [""])[0] or "").strip()
-    body = (form.get("Body", [""])[0] or "").strip()
+    from_ = (form.get("From") or "").strip()
+    body = (form.get("Body") or "").strip()
     text = body.lower().strip()
 
     if not from_:
-        return PlainTextResponse(twiml("Erro: From vazio."), media_type="application/xml")
+        return _twiml_reply("Erro: From vazio.")
+
+    s = await get_session(from_)
+    try:
+        return await _webhook_turn(from_, body, text, s)
+    except _AlreadySubmitting:
+        s = None  # duplicada: nao regrava a sessao lida antes do confirmar
+        return _twiml_reply("Proposta ja esta em processamento. Aguarde.")
+    finally:
+        # grava mesmo se o turno falhar no meio (ex.: erro no Twilio/DB)
+        if s is not None:
+            await store_session(from_, s)
 
-    s = get_session(from_)
 
+async def _webhook_turn(from_: str, body: str, text: str, s: Dict[str, Any]) -> PlainTextResponse:
     # comandos globais
     if text in ("cancelar", "cancel", "sair", "reset"):
-        reset_session(from_)
-        return PlainTextResponse(twiml("Sessao cancelada. Para iniciar: digite 'nova'."), media_type="application/xml")
+        reset_session(from_, s)
+        return _twiml_reply("Sessao cancelada. Para iniciar: digite 'nova'.")
 
     if text in ("ajuda", "help", "?"):
-        return PlainTextResponse(twiml(
+        return _twiml_reply(
             "Comandos:\n- nova (inicia proposta)\n- cancelar (zera sessao)\n\nSiga as perguntas e responda com os valores."
-        ), media_type="application/xml")
+        )
 
     # iniciar
     if s["step"] == "idle":
         if text in ("nova", "iniciar", "proposta", "orcamento", "orçamento"):
             s["step"] = "client_name"
-            return PlainTextResponse(twiml("Vamos iniciar a proposta.\n\nNome do cliente?"), media_type="application/xml")
-        return PlainTextResponse(twiml("Digite 'nova' para iniciar uma proposta ou 'ajuda'."), media_type="application/xml")
+            return _twiml_reply("Vamos iniciar a proposta.\n\nNome do cliente?")
+        return _twiml_reply("Digite 'nova' para iniciar uma proposta ou 'ajuda'.")
 
     # coleta cliente
     if s["step"] == "client_name":
         if len(body) < 2:
-            return PlainTextResponse(twiml("Nome invalido. Informe o nome do cliente:"), media_type="application/xml")
+            return _twiml_reply("Nome invalido. Informe o nome do cliente:")
         s["client"]["name"] = body
         s["step"] = "client_email"
-        return PlainTextResponse(twiml("E-mail do cliente?"), media_type="application/xml")
+        return _twiml_reply("E-mail do cliente?")
 
     if s["step"] == "client_email":
         # validacao simples (deixa o pydantic validar depois tambem)
         if "@" not in body or "." not in body:
-            return PlainTextResponse(twiml("E-mail invalido. Informe novamente:"), media_type="application/xml")
+            return _twiml_reply("E-mail invalido. Informe novamente:")
         s["client"]["email"] = body
         s["step"] = "client_phone"
-        return PlainTextResponse(twiml("Telefone do cliente? (ex: +55 67 99999-9999)"), media_type="application/xml")
+        return _twiml_reply("Telefone do cliente? (ex: +55 67 99999-9999)")
 
     if s["step"] == "client_phone":
         if len(body) < 8:
-            return PlainTextResponse(twiml("Telefone invalido. Informe novamente:"), media_type="application/xml")
+            return _twiml_reply("Telefone invalido. Informe novamente:")
         s["client"]["phone"] = body
         s["step"] = "client_address"
-        return PlainTextResponse(twiml("Endereco do cliente? (ou digite 0 para pular)"), media_type="application/xml")
+        return _twiml_reply("Endereco do cliente? (ou digite 0 para pular)")
 
     if s["step"] == "client_address":
         s["client"]["address"] = "" if body.strip() == "0" else body.strip()
         s["step"] = "items_0"
-        return PlainTextResponse(twiml(next_item_prompt(0) or "Informe o primeiro item."), media_type="application/xml")
+        return _twiml_reply(next_item_prompt(0) or "Informe o primeiro item.")
 
     # itens (sequencial)
     if s["step"].startswith("items_"):
         idx = int(s["step"].split("_")[1])
         n = parse_int_0_99(body)
         if n is None:
-            return PlainTextResponse(twiml("Valor invalido. Responda com numero de 0 a 99."), media_type="application/xml")
+            return _twiml_reply("Valor invalido. Responda com numero de 0 a 99.")
 
         key = next_item_key(idx)
         if key:
@@ -966,10 +1156,10 @@ async def twilio_webhook(request: Request):
         next_idx = idx + 1
         if next_idx < len(WIZARD_ITEMS_ORDER):
             s["step"] = f"items_{next_idx}"
-            return PlainTextResponse(twiml(next_item_prompt(next_idx) or "Informe o proximo item."), media_type="application/xml")
+            return _twiml_reply(next_item_prompt(next_idx) or "Informe o proximo item.")
 
         s["step"] = "notes"
-        return PlainTextResponse(twiml("Observacoes da vistoria? (ou digite 0 para pular)"), media_type="application/xml")
+        return _twiml_reply("Observacoes da vistoria? (ou digite 0 para pular)")
 
     # notes
     if s["step"] == "notes":
@@ -988,62 +1178,37 @@ async def twilio_webhook(request: Request):
             f"- 3x: R$ {totals['card_installment_value']:.2f}\n\n"
             "Gerar e enviar proposta agora? (sim/nao)"
         )
-        return PlainTextResponse(twiml(msg), media_type="application/xml")
+        return _twiml_reply(msg)
 
     # confirm
     if s["step"] == "confirm":
         if text in ("nao", "não", "n"):
             s["step"] = "idle"
-            return PlainTextResponse(twiml("Ok. Sessao encerrada. Digite 'nova' para iniciar outra."), media_type="application/xml")
+            return _twiml_reply("Ok. Sessao encerrada. Digite 'nova' para iniciar outra.")
 
         if text not in ("sim", "s", "yes", "y"):
-            return PlainTextResponse(twiml("Responda apenas 'sim' ou 'nao'."), media_type="application/xml")
+            return _twiml_reply("Responda apenas 'sim' ou 'nao'.")
 
         # envia proposta (reusa pipeline atual)
         try:
-            # evita CC duplicado
-            seller_email = resolve_seller_email(s["seller_phone"])
-            if seller_email and seller_email.strip().lower() == str(s["client"]["email"]).strip().lower():
-                seller_email = None
-
-            quote = compute_quote(s["items"])
-            context = {
-                "company_name": COMPANY_NAME,
-                "client": s["client"],
-                "notes": s["notes"],
-                "breakdown": quote["breakdown"],
-                "totals": quote["totals"],
-            }
-            pdf_bytes = render_pdf_reportlab(context)
-
-            subject = f"Proposta - Automacao - {s['client']['name']}"
-            html_body = f"""
-            <p>Ola, <b>{s['client']['name']}</b>!</p>
-            <p>Segue em anexo sua proposta de automacao.</p>
-            <p>
-              <b>Valor total:</b> R$ {quote['totals']['grand_total']:.2f}<br/>
-              <b>A vista (10% off):</b> R$ {quote['totals']['cash_total']:.2f}<br/>
-              <b>Cartao:</b> {quote['totals']['card_installments']}x de R$ {quote['totals']['card_installment_value']:.2f} (sem juros)
-            </p>
-            <p>- {COMPANY_NAME}</p>
-            """
-
-            send_email_sendgrid(
-                to_email=str(s["client"]["email"]),
-                cc_email=seller_email,
-                subject=subject,
-                html_body=html_body,
-                pdf_bytes=pdf_bytes,
-                filename=f"Proposta_{s['client']['name'].replace(' ', '_')}.pdf",
+            payload = FlowSubmit(
+                seller_phone=s["seller_phone"],
+                client=Client(**s["client"]),
+                items=s["items"],
+                notes=s["notes"],
             )
-
+            _, send_args = _prepare_submission(payload)
         except Exception as e:
             # mantem sessao para tentar novamente
-            return PlainTextResponse(twiml(f"Falha ao enviar: {e}"), media_type="application/xml")
+            return _twiml_reply(f"Falha ao enviar: {e}")
+
+        if not await _acquire_submit_lock(from_):
+            raise _AlreadySubmitting()
+        _spawn(_generate_and_send(send_args, notify_to=from_))
 
         # encerra e limpa
-        reset_session(from_)
-        return PlainTextResponse(twiml("Proposta gerada e enviada por e-mail. Digite 'nova' para outra."), media_type="application/xml")
+        reset_session(from_, s)
+        return _twiml_reply("Proposta em processamento, o cliente recebe por e-mail em instantes. Digite 'nova' para outra.")
 
     # fallback
-    return PlainTextResponse(twiml("Nao entendi. Digite 'ajuda'."), media_type="application/xml")
+    return _twiml_reply("Nao entendi. Digite 'ajuda'.")
@@ -12,11 +12,22 @@ if DATABASE_URL.startswith("postgres://"):
 if DATABASE_URL.startswith("postgresql://") and "+psycopg" not in DATABASE_URL:
     DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg://", 1)
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# pool explicito; sem pre_ping (SELECT 1 a cada checkout): pool_recycle
+# descarta conexoes antes do idle timeout do Postgres do Render
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=5,
+    pool_recycle=300,
+    pool_pre_ping=False,
+)
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 
 
 def init_db():
+    # um unico round-trip no startup (psycopg aceita varios statements sem parametros)
     with engine.begin() as conn:
         conn.execute(text("""
         create table if not exists sessions (
@@ -25,8 +36,7 @@ def init_db():
             payload jsonb not null,
             updated_at timestamptz not null default now()
         );
-        """))
-        conn.execute(text("""
+        create index if not exists sessions_updated_at_idx on sessions(updated_at);
         create table if not exists proposals (
             id uuid primary key default gen_random_uuid(),
             wa_from text not null,
@@ -0,0 +1,147 @@
+# Renderizacao do PDF da proposta (ReportLab).
+# Sem efeitos colaterais no import: os workers do _PDF_POOL (app.py) importam
+# so este modulo, sem subir clientes HTTP/Twilio/Redis/DB do app.
+import re
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+
+# formatador de moeda pre-ligado (evita reinterpretar o format spec por celula)
+FMT_BRL = "R$ {:.2f}".format
+
+
+_WS_RE = re.compile(r"\s+")
+
+
+def split_text(text: str, max_len: int):
+    # quebra gulosa por indices: normaliza espacos uma vez e corta no
+    # ultimo espaco que cabe na linha (palavra maior que max_len fica sozinha)
+    text = _WS_RE.sub(" ", text or "").strip()
+    lines = []
+    start, n = 0, len(text)
+    while n - start > max_len:
+        cut = text.rfind(" ", start, start + max_len + 1)
+        if cut <= start:
+            cut = text.find(" ", start + max_len)
+            if cut < 0:
+                break
+        lines.append(text[start:cut])
+        start = cut + 1
+    if start < n:
+        lines.append(text[start:])
+    return lines
+
+
+# Layout do PDF (A4)
+_PAGE_H = A4[1]
+_X0 = 40
+_Y0 = _PAGE_H - 50
+_F_REG = "Helvetica"
+_F_BOLD = "Helvetica-Bold"
+_F_MONO = "Courier"
+_F_MONO_BOLD = "Courier-Bold"
+
+# Linha da tabela de materiais (Courier 10pt = 6pt/char): as colunas
+# terminam em x+300 (Qtd), x+378 (Unit) e x+516 (Total)
+_TABLE_ROW = "{:<40}{:>10}{:>13}{:>23}".format
+
+
+def render_pdf_reportlab(context: dict) -> bytes:
+    """
+    Gera PDF (A4) com:
+      - Materiais detalhados
+      - Mão de obra (total)
+      - Condições de pagamento
+    Todo o texto de uma pagina vai num unico PDFTextObject (um BT/ET).
+    """
+    # sem BytesIO: o ReportLab serializa o documento inteiro de uma vez no
+    # final, entao getpdfdata() devolve os bytes sem a copia extra do buffer
+    c = canvas.Canvas(None, pagesize=A4)
+
+    y = _Y0
+    to = c.beginText(_X0, y)
+    state = [None, None, None]  # fonte, tamanho e leading atuais do text object
+
+    def set_font(font, size, leading):
+        # so emite Tf (ou TL) quando algo muda
+        if state[0] != font or state[1] != size:
+            to.setFont(font, size, leading=leading)
+        elif state[2] != leading:
+            to.setLeading(leading)
+        state[:] = (font, size, leading)
+
+    def line(txt, dy=16, bold=False, size=11):
+        nonlocal y
+        set_font(_F_BOLD if bold else _F_REG, size, dy)
+        to.textLine(txt)
+        y -= dy
+
+    def gap(dy):
+        nonlocal y
+        to.moveCursor(0, dy)
+        y -= dy
+
+    # Header
+    line("Proposta de Automação", dy=18, bold=True, size=15)
+    line(context.get("company_name", ""), dy=24)
+
+    # Cliente
+    client = context["client"]
+    line("Cliente", bold=True)
+    line(f"Nome: {client.get('name','')}")
+    line(f"E-mail: {client.get('email','')}")
+    line(f"Telefone: {client.get('phone','')}")
+    addr = client.get("address")
+    if addr:
+        line(f"Endereço: {addr}")
+    gap(10)
+
+    # Observações
+    notes = (context.get("notes") or "").strip()
+    if notes:
+        line("Observações da vistoria", bold=True)
+        for chunk in split_text(notes, 95):
+            line(chunk, size=10, dy=13)
+        gap(10)
+
+    # Materiais - tabela
+    line("Materiais", bold=True)
+
+    # tabela em fonte monoespacada: colunas alinhadas por padding,
+    # uma linha de texto por item (sem medir cada celula)
+    set_font(_F_MONO_BOLD, 10, 14)
+    to.textLine(_TABLE_ROW("Item", "Qtd", "Unit", "Total"))
+    y -= 14
+
+    set_font(_F_MONO, 10, 14)
+    for row in context["breakdown_rows"]:
+        if y < 140:
+            c.drawText(to)
+            c.showPage()
+            y = _Y0
+            to = c.beginText(_X0, y)
+            state[:] = (None, None, None)
+            set_font(_F_MONO, 10, 14)
+
+        to.textLine(_TABLE_ROW(*row))
+        y -= 14
+
+    gap(12)
+
+    totals = context["totals"]
+    line(f"Total materiais: R$ {totals['material_total']:.2f}", bold=True)
+    line(f"Mão de obra: R$ {totals['labor_total']:.2f}", bold=True)
+    line(f"Valor total: R$ {totals['grand_total']:.2f}", bold=True)
+    gap(6)
+
+    line("Condições de pagamento", bold=True)
+    line(f"À vista (10% desconto): R$ {totals['cash_total']:.2f}")
+    line(f"Cartão: {totals['card_installments']}x sem juros de R$ {totals['card_installment_value']:.2f}")
+    gap(10)
+
+    line("Valores calculados automaticamente com base no escopo informado.", dy=12, size=9)
+
+    c.drawText(to)
+    c.showPage()
+    return c.getpdfdata()